@@ -15,14 +15,27 @@ Date: August 2025
 import os
 import sys
 import shutil
-import psycopg2
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
 import hashlib
+import io
+import mmap
 from pathlib import Path
-from PIL import Image
+from PIL import Image, features
 import argparse
+from collections import Counter
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
 import logging
 
+# pyvips is optional; without it (or without the libvips shared library)
+# every image goes through Pillow
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 # Import private configuration if available
 try:
     from config_private import DB_CONFIG, HOMEBOX_DATA_PATH
@@ -42,9 +55,46 @@ SUPPORTED_FORMATS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif'}
 TARGET_FORMAT = 'webp'
 TARGET_MIME = 'image/webp'
 
+# Extensions worth sniffing during discovery; files with any other extension
+# are skipped without being opened (extensionless files are always sniffed)
+CANDIDATE_EXTENSIONS = SUPPORTED_FORMATS | {'.webp'}
+
+# Leading magic bytes for each image format we recognise (WebP and BMP are
+# checked separately: WebP's signature is split around the RIFF chunk size,
+# and BMP's two-byte "BM" on its own matches plain text too easily)
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', '.jpeg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'II*\x00', '.tiff'),
+    (b'MM\x00*', '.tiff'),
+)
+
+# Valid BMP DIB header sizes (BITMAPCOREHEADER through BITMAPV5HEADER)
+BMP_DIB_HEADER_SIZES = {12, 40, 52, 56, 64, 108, 124}
+
 # WebP quality settings
 WEBP_QUALITY = 85  # Good balance between quality and compression
-WEBP_METHOD = 6    # Compression method (0-6, higher = better compression)
+WEBP_METHOD = 4    # Encoder effort (0-6); 6 is 2-3x slower for <1% smaller files
+
+# Number of images each worker converts between releases of Pillow's block cache
+PILLOW_CACHE_CLEAR_INTERVAL = 256
+
+# Conversions kept queued per worker process. Bounding this keeps discovery
+# streaming and caps how many finished .webp.tmp files wait to be moved into place
+MAX_IN_FLIGHT_PER_WORKER = 2
+
+# Number of discovered images buffered and sorted by size before dispatch
+SORT_BATCH_SIZE = 1024
+
+# Number of attachments whose MIME type is updated per round trip
+DB_BATCH_SIZE = 500
+
+# Database connection pool bounds
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 4
+DB_CONNECT_TIMEOUT = 5  # seconds
 
 def setup_logging():
     """Set up logging configuration"""
@@ -60,236 +110,539 @@ def setup_logging():
     return logging.getLogger(__name__)
 
 def create_backup(source_path, backup_dir):
-    """Create a backup of the original file"""
+    """Create a backup of the original file
+
+    On the same filesystem the backup is a hard link to the original inode,
+    which costs no data copy. This is safe because the converted file is
+    swapped in with os.replace (a new inode) rather than written in place.
+    """
     backup_path = backup_dir / Path(source_path).name
-    shutil.copy2(source_path, backup_path)
+    backup_path.unlink(missing_ok=True)
+    try:
+        os.link(source_path, backup_path)
+    except OSError:
+        # No hard link possible: another filesystem (EXDEV), no link support
+        # (EPERM/ENOTSUP), too many links (EMLINK), fs.protected_hardlinks, ...
+        try:
+            shutil.copy2(source_path, backup_path)
+        except Exception:
+            # Don't leave a truncated copy (e.g. after ENOSPC) looking like a backup
+            backup_path.unlink(missing_ok=True)
+            raise
     return backup_path
 
 def get_file_hash(file_path):
     """Calculate SHA256 hash of a file for integrity checking"""
-    hash_sha256 = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_sha256.update(chunk)
-    return hash_sha256.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: large internal buffer, GIL released while hashing
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        hash_sha256 = hashlib.sha256()
+        if os.fstat(f.fileno()).st_size:
+            # mmap cannot map empty files
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hash_sha256.update(mm)
+        return hash_sha256.hexdigest()
+
+def _convert_with_vips(input_path, quality, method, preserve_metadata):
+    """Encode an image to WebP bytes with libvips, streaming it in a single pass"""
+    img = pyvips.Image.new_from_file(str(input_path), access='sequential')
+    # libvips' effort is the same 0-6 scale as libwebp's method
+    return img.webpsave_buffer(Q=quality, effort=method, strip=not preserve_metadata)
 
-def convert_to_webp(input_path, output_path, quality=WEBP_QUALITY):
-    """Convert an image to WebP format"""
+def _convert_with_pillow(input_path, quality, method, preserve_metadata):
+    """Encode an image to WebP bytes with Pillow"""
+    # Decode from a read-only mapping of the file rather than through buffered reads
+    with open(input_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        img = Image.open(mm)
+        
+        # EXIF/ICC/XMP are discarded unless asked for; phone photos can carry
+        # tens of KB of metadata that would otherwise be re-emitted
+        if preserve_metadata:
+            metadata = {key: img.info[key] for key in ('exif', 'icc_profile', 'xmp') if key in img.info}
+        else:
+            metadata = {'exif': b'', 'icc_profile': b'', 'xmp': b''}
+        
+        # WebP encodes RGB and RGBA directly, so only convert other modes
+        # (P, CMYK, I, F, ...), keeping transparency where there is any
+        if img.mode not in ('RGB', 'RGBA', 'L'):
+            has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        
+        # Save as WebP
+        buf = io.BytesIO()
+        img.save(
+            buf,
+            'WebP',
+            quality=quality,
+            lossless=False,
+            method=method,
+            **metadata
+        )
+        
+        # The source pages won't be read again; drop them from this mapping
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            mm.madvise(mmap.MADV_DONTNEED)
+        return buf.getbuffer()
+
+def convert_to_webp(input_path, quality=WEBP_QUALITY, method=WEBP_METHOD, preserve_metadata=False):
+    """Encode an image to WebP in memory, using libvips when available
+
+    Returns the encoded bytes, or None if the image could not be converted.
+    """
+    if pyvips is not None:
+        try:
+            return _convert_with_vips(input_path, quality, method, preserve_metadata)
+        except pyvips.Error as e:
+            # e.g. a format this libvips build has no loader for; let Pillow try
+            logging.debug(f"libvips could not convert {input_path}, falling back to Pillow: {e}")
+    
     try:
-        with Image.open(input_path) as img:
-            # Convert RGBA to RGB if necessary (WebP supports both, but RGB is more efficient)
-            if img.mode in ('RGBA', 'LA'):
-                # Create a white background for transparency
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'RGBA':
-                    background.paste(img, mask=img.split()[-1])  # Use alpha channel as mask
-                else:
-                    background.paste(img)
-                img = background
-            elif img.mode not in ('RGB', 'L'):
-                img = img.convert('RGB')
-            
-            # Save as WebP
-            img.save(
-                output_path,
-                'WebP',
-                quality=quality,
-                method=WEBP_METHOD,
-                optimize=True
-            )
-            return True
+        return _convert_with_pillow(input_path, quality, method, preserve_metadata)
     except Exception as e:
         logging.error(f"Failed to convert {input_path}: {e}")
-        return False
+        return None
+
+_images_since_cache_clear = 0
+
+def _release_pillow_cache():
+    """Periodically free Pillow's pooled image memory in this worker process"""
+    global _images_since_cache_clear
+    _images_since_cache_clear += 1
+    if _images_since_cache_clear >= PILLOW_CACHE_CLEAR_INTERVAL:
+        _images_since_cache_clear = 0
+        clear_cache = getattr(Image.core, 'clear_cache', None)
+        if clear_cache:
+            clear_cache()
 
-def get_database_connection():
-    """Establish database connection"""
+def _remove_temp_file(temp_webp):
+    """Delete a leftover (possibly partly written) temp file, if there is one"""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
+        temp_webp.unlink(missing_ok=True)
+    except OSError as e:
+        logging.warning(f"Could not remove temporary file {temp_webp}: {e}")
+
+def _process_one(image, backup_dir, quality, method, preserve_metadata):
+    """Back up and convert a single (path, size) image (runs in a worker process)
+
+    Returns a tuple of (path, status, original_size, new_size, temp_webp), where
+    status is 'converted', 'backup_failed' or 'failed'. The original is never
+    modified here; moving the WebP into place and updating the database is left
+    to the main process.
+    """
+    img_path, original_size = image
+    
+    # Convert to WebP (in-place, keeping the same filename but changing content).
+    # The temp name keeps the full filename so item.png and item.jpg in the same
+    # directory, converted in parallel, never share a temp file
+    temp_webp = img_path.with_name(img_path.name + '.webp.tmp')
+    
+    # Never convert a file we could not back up
+    try:
+        create_backup(img_path, backup_dir)
+    except Exception as e:
+        logging.error(f"Backup failed for {img_path}: {e}")
+        return img_path, 'backup_failed', original_size, 0, temp_webp
+    
+    try:
+        # Hold a descriptor on the original through the encode so its cached
+        # pages can be dropped afterwards; each file is only read once
+        with open(img_path, 'rb') as f:
+            data = convert_to_webp(img_path, quality, method, preserve_metadata)
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                except OSError:
+                    # Only a cache hint; never fail a finished encode over it
+                    pass
+        _release_pillow_cache()
+        if data is not None:
+            # Encoded in memory, so only a successful conversion touches the disk
+            temp_webp.write_bytes(data)
+            return img_path, 'converted', original_size, len(data), temp_webp
+    except Exception as e:
+        logging.error(f"Error processing {img_path}: {e}")
+    _remove_temp_file(temp_webp)
+    return img_path, 'failed', original_size, 0, temp_webp
+
+def _convert_images(executor, images, max_in_flight, *args):
+    """Run _process_one over images, yielding results as they complete
+
+    At most max_in_flight conversions are submitted at once. If the caller
+    stops early (an error or Ctrl-C), queued conversions are cancelled and the
+    temp files of any that still finish are removed.
+    """
+    in_flight = set()
+    done = set()
+    try:
+        for image in images:
+            while len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                while done:
+                    yield done.pop().result()
+            in_flight.add(executor.submit(_process_one, image, *args))
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            while done:
+                yield done.pop().result()
+    finally:
+        leftover = in_flight | done
+        for future in leftover:
+            future.cancel()
+        for future in leftover:
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            _remove_temp_file(result[-1])
+
+def get_database_pool():
+    """Open a database connection pool"""
+    params = dict(DB_CONFIG)
+    # DB_CONFIG uses psycopg2's 'database' key; libpq calls it 'dbname'
+    if 'database' in params:
+        params['dbname'] = params.pop('database')
+    
+    pool = None
+    try:
+        pool = ConnectionPool(
+            make_conninfo(**params),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            check=ConnectionPool.check_connection,
+            open=False
+        )
+        # Fail fast on bad credentials instead of waiting out the pool's 30 s default
+        pool.open(wait=True, timeout=DB_CONNECT_TIMEOUT)
+        return pool
     except Exception as e:
         logging.error(f"Database connection failed: {e}")
+        if pool:
+            pool.close()
         return None
 
-def update_database_mime_type(conn, file_path, new_mime_type):
-    """Update the MIME type in the database for a given file path"""
+def get_db_path(file_path, base_path):
+    """Return the attachments.path value for a file under the Homebox data directory base_path"""
+    # The path in the database includes the data/ prefix
+    return f"data/{file_path.relative_to(base_path)}"
+
+def ensure_attachment_path_index(pool):
+    """Create a b-tree index on attachments.path if there isn't one already"""
+    with pool.connection() as conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_attachments_path ON attachments (path)")
+
+def load_attachment_ids(pool):
+    """Load a mapping of attachments.path to attachment id in a single query"""
+    with pool.connection() as conn:
+        rows = conn.execute("SELECT id, path FROM attachments").fetchall()
+    return {path: attachment_id for attachment_id, path in rows}
+
+def update_database_mime_types(pool, attachment_ids, new_mime_type):
+    """Set the MIME type for a batch of attachment ids in a single statement"""
     try:
-        cursor = conn.cursor()
-        
-        # The path in the database includes the data/ prefix
-        db_path = f"data/{file_path.relative_to(Path(HOMEBOX_DATA_PATH))}"
-        
-        # Update MIME type for the file
-        cursor.execute(
-            "UPDATE attachments SET mime_type = %s WHERE path = %s",
-            (new_mime_type, str(db_path))
-        )
-        
-        rows_affected = cursor.rowcount
-        conn.commit()
-        cursor.close()
-        
-        return rows_affected > 0
+        # The pool commits on a clean exit and rolls back on error
+        with pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE attachments SET mime_type = %s WHERE id = ANY(%s)",
+                (new_mime_type, attachment_ids)
+            )
+            return cursor.rowcount
     except Exception as e:
-        logging.error(f"Database update failed for {file_path}: {e}")
-        conn.rollback()
-        return False
+        logging.error(f"Database update failed for batch of {len(attachment_ids)} files: {e}")
+        return None
 
-def find_image_files(data_path):
-    """Find all image files in the Homebox data directory"""
-    image_files = []
-    data_path = Path(data_path)
-    
-    for file_path in data_path.rglob('*'):
-        if file_path.is_file():
-            # Check if it's an image by extension
-            if file_path.suffix.lower() in SUPPORTED_FORMATS:
-                image_files.append(file_path)
-            # Also check files without extensions that might be images
-            elif not file_path.suffix:
-                try:
-                    with Image.open(file_path) as img:
-                        # If we can open it as an image, it's an image
-                        image_files.append(file_path)
-                except:
-                    # Not an image, skip
-                    pass
+def _scan_files(dir_path):
+    """Recursively yield DirEntry objects for regular files under dir_path
+
+    Unreadable or vanished directories are logged and skipped, as rglob did.
+    """
+    try:
+        entries = os.scandir(dir_path)
+    except (PermissionError, FileNotFoundError) as e:
+        logging.warning(f"Skipping directory {dir_path}: {e}")
+        return
+    with entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_file = not is_dir and entry.is_file(follow_symlinks=False)
+            except (PermissionError, FileNotFoundError) as e:
+                logging.warning(f"Skipping {entry.path}: {e}")
+                continue
+            if is_dir:
+                yield from _scan_files(entry.path)
+            elif is_file:
+                yield entry
+
+def sniff_image_format(file_path):
+    """Identify an image format from its first 32 bytes, returning None if it isn't one"""
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(32)
+    except OSError:
+        return None
     
-    return image_files
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    # "BM" followed, after the 14-byte file header, by a known DIB header size
+    if head[:2] == b'BM' and int.from_bytes(head[14:18], 'little') in BMP_DIB_HEADER_SIZES:
+        return '.bmp'
+    for signature, fmt in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    return None
+
+def find_image_files(data_path):
+    """Find all image files in the Homebox data directory
+
+    Files are identified by their magic bytes rather than their extension.
+    Yields (path, size, fmt) tuples; the size comes from the directory entry's
+    cached stat so each file is only stat'ed once.
+    """
+    for entry in _scan_files(data_path):
+        # Plain string test on the entry name; a Path is only built for matches
+        stem, _, ext = entry.name.rpartition('.')
+        if stem and f".{ext.lower()}" not in CANDIDATE_EXTENSIONS:
+            continue
+        fmt = sniff_image_format(entry.path)
+        if not fmt:
+            continue
+        try:
+            size = entry.stat(follow_symlinks=False).st_size
+        except (PermissionError, FileNotFoundError) as e:
+            logging.warning(f"Skipping {entry.path}: {e}")
+            continue
+        yield Path(entry.path), size, fmt
+
+def _largest_first(images, batch_size=SORT_BATCH_SIZE):
+    """Re-yield (path, size) images in batches sorted by size, largest first
+
+    Starting the slowest encodes first keeps workers evenly loaded near the
+    end of each batch, while batching keeps discovery streaming.
+    """
+    batch = []
+    for image in images:
+        batch.append(image)
+        if len(batch) >= batch_size:
+            batch.sort(key=lambda item: item[1], reverse=True)
+            yield from batch
+            batch = []
+    batch.sort(key=lambda item: item[1], reverse=True)
+    yield from batch
 
 def analyze_images(image_files):
     """Analyze current image collection"""
     total_size = 0
-    format_counts = {}
+    format_counts = Counter()
     
-    for img_path in image_files:
-        try:
-            total_size += img_path.stat().st_size
-            
-            # Determine format
-            if img_path.suffix:
-                fmt = img_path.suffix.lower()
-            else:
-                # Try to determine format from file content
-                try:
-                    with Image.open(img_path) as img:
-                        fmt = f".{img.format.lower()}"
-                except:
-                    fmt = ".unknown"
-            
-            format_counts[fmt] = format_counts.get(fmt, 0) + 1
-            
-        except Exception as e:
-            logging.warning(f"Could not analyze {img_path}: {e}")
+    for img_path, size, fmt in image_files:
+        total_size += size
+        format_counts[fmt] += 1
     
     return total_size, format_counts
 
+def positive_int(value):
+    """argparse type for integer options that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description='Optimize Homebox images by converting to WebP')
     parser.add_argument('--dry-run', action='store_true', help='Show what would be done without making changes')
     parser.add_argument('--backup-dir', type=str, help='Directory to store backups (default: ./backups)')
     parser.add_argument('--quality', type=int, default=WEBP_QUALITY, help=f'WebP quality (1-100, default: {WEBP_QUALITY})')
+    parser.add_argument('--method', type=int, default=WEBP_METHOD, choices=range(7), metavar='{0-6}', help=f'WebP encoder effort (0-6, default: {WEBP_METHOD}). Higher is slower; 6 is 2-3x slower than 4 for typically <1%% smaller files')
+    parser.add_argument('--preserve-metadata', action='store_true', help='Keep EXIF, ICC profile and XMP metadata (discarded by default for smaller files)')
     parser.add_argument('--skip-database', action='store_true', help='Skip database updates (file conversion only)')
     parser.add_argument('--data-path', type=str, help='Override Homebox data path')
+    parser.add_argument('--ensure-index', action='store_true', help='Create an index on attachments(path) if missing')
+    parser.add_argument('--analyze', action='store_true', help='Scan and summarize the whole collection before converting (delays the first conversion)')
+    parser.add_argument('--workers', type=positive_int, default=os.cpu_count(), help='Number of parallel conversion processes (default: CPU count)')
     
     args = parser.parse_args()
     
     logger = setup_logging()
     logger.info("Starting Homebox image optimization")
     
+    # Source builds of Pillow (e.g. Pillow-SIMD) silently drop WebP if libwebp was missing
+    if not features.check('webp'):
+        logger.error("This Pillow build has no WebP support; reinstall Pillow with libwebp available")
+        sys.exit(1)
+    
     # Override data path if provided
     data_path = args.data_path if args.data_path else HOMEBOX_DATA_PATH
+    base_path = Path(data_path)
     
     # Set up backup directory
     backup_dir = Path(args.backup_dir) if args.backup_dir else Path('./backups')
     backup_dir.mkdir(exist_ok=True)
     
-    # Find all image files
+    # Find all image files; discovery is streamed straight into the worker pool
+    # unless a full analysis pass is requested
     logger.info(f"Scanning for images in {data_path}")
     image_files = find_image_files(data_path)
-    logger.info(f"Found {len(image_files)} image files")
-    
-    if not image_files:
-        logger.info("No image files found to optimize")
-        return
     
-    # Analyze current collection
-    total_size, format_counts = analyze_images(image_files)
-    logger.info(f"Current collection: {total_size / (1024*1024):.2f} MB")
-    logger.info("Format distribution:")
-    for fmt, count in sorted(format_counts.items()):
-        logger.info(f"  {fmt}: {count} files")
+    if args.dry_run or args.analyze:
+        image_files = list(image_files)
+        logger.info(f"Found {len(image_files)} image files")
+        
+        if not image_files:
+            logger.info("No image files found to optimize")
+            return
+        
+        # Analyze current collection
+        total_size, format_counts = analyze_images(image_files)
+        logger.info(f"Current collection: {total_size / (1024*1024):.2f} MB")
+        logger.info("Format distribution:")
+        for fmt, count in sorted(format_counts.items()):
+            logger.info(f"  {fmt}: {count} files")
     
     if args.dry_run:
         logger.info("DRY RUN: Would convert all images to WebP format")
         return
     
-    # Set up database connection
-    conn = None
+    # Set up database connection pool
+    pool = None
     if not args.skip_database:
-        conn = get_database_connection()
-        if not conn:
+        pool = get_database_pool()
+        if not pool:
             logger.error("Could not connect to database. Use --skip-database to continue with file conversion only.")
             return
     
-    # Process each image
+    if pool and args.ensure_index:
+        try:
+            ensure_attachment_path_index(pool)
+            logger.info("Ensured index idx_attachments_path on attachments(path)")
+        except Exception as e:
+            logger.warning(f"Could not create index on attachments(path): {e}")
+    
+    # Fetch all attachment paths once so files without a database row cost no round trip
+    path_to_id = {}
+    if pool:
+        try:
+            path_to_id = load_attachment_ids(pool)
+        except Exception as e:
+            logger.error(f"Could not load attachments from database: {e}")
+            pool.close()
+            return
+        logger.info(f"Loaded {len(path_to_id)} attachment records")
+    
+    # Convert images in parallel; file moves and database updates stay on the main process
     converted_count = 0
     failed_count = 0
     total_saved = 0
+    total_size = 0
+    skipped_count = 0
+    pending_updates = []
     
-    for img_path in image_files:
-        try:
-            logger.info(f"Processing: {img_path.name}")
-            
-            # Skip if already WebP
-            if img_path.suffix.lower() == '.webp':
-                logger.info(f"  Already WebP, skipping")
+    def flush_updates():
+        rows_affected = update_database_mime_types(pool, pending_updates, TARGET_MIME)
+        if rows_affected is None:
+            logger.warning(f"  Database update failed for {len(pending_updates)} files")
+        else:
+            logger.info(f"  Database updated: {rows_affected} rows for {len(pending_updates)} files")
+        pending_updates.clear()
+    
+    def queue_mime_update(img_path):
+        if not pool:
+            return
+        attachment_id = path_to_id.get(get_db_path(img_path, base_path))
+        if attachment_id is None:
+            logger.warning(f"  No attachment record for {img_path.name}, database not updated")
+            return
+        pending_updates.append(attachment_id)
+        if len(pending_updates) >= DB_BATCH_SIZE:
+            flush_updates()
+    
+    def images_to_convert():
+        nonlocal skipped_count
+        for img_path, size, fmt in image_files:
+            # Skip if already WebP, but still fix its MIME type in case an
+            # earlier run was interrupted before its database update
+            if fmt == '.webp':
+                logger.info(f"Skipping {img_path.name}: already WebP")
+                skipped_count += 1
+                queue_mime_update(img_path)
                 continue
+            yield img_path, size
+    
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            conversions = _convert_images(
+                executor,
+                _largest_first(images_to_convert()),
+                args.workers * MAX_IN_FLIGHT_PER_WORKER,
+                backup_dir,
+                args.quality,
+                args.method,
+                args.preserve_metadata
+            )
             
-            # Create backup
-            backup_path = create_backup(img_path, backup_dir)
-            original_size = img_path.stat().st_size
-            
-            # Convert to WebP (in-place, keeping the same filename but changing content)
-            temp_webp = img_path.with_suffix('.webp.tmp')
+            # closing() runs the generator's cleanup before the executor shuts down
+            with closing(conversions) as results:
+                for img_path, status, original_size, new_size, temp_webp in results:
+                    try:
+                        logger.info(f"Processing: {img_path.name}")
+                        total_size += original_size
+                        
+                        if status == 'converted':
+                            # Replace original with WebP version (keeping original filename);
+                            # the temp file sits next to the original, so this is a single atomic rename
+                            os.replace(temp_webp, img_path)
+                            
+                            # Queue database update if requested
+                            queue_mime_update(img_path)
+                            
+                            converted_count += 1
+                            saved = original_size - new_size
+                            total_saved += saved
+                            
+                            logger.info(f"  Converted: {original_size/1024:.1f}KB → {new_size/1024:.1f}KB (saved {saved/1024:.1f}KB)")
+                            
+                        elif status == 'backup_failed':
+                            failed_count += 1
+                            logger.error(f"  Backup failed, skipped (original left unchanged)")
+                            
+                        else:
+                            failed_count += 1
+                            # The original is only ever replaced by os.replace above, so
+                            # there is nothing to restore
+                            logger.error(f"  Conversion failed, original left unchanged")
+                            
+                    except Exception as e:
+                        failed_count += 1
+                        logger.error(f"Error processing {img_path}: {e}")
+                        _remove_temp_file(temp_webp)
+                    except BaseException:
+                        # Interrupted mid-file; a no-op if it was already moved into place
+                        _remove_temp_file(temp_webp)
+                        raise
             
-            if convert_to_webp(img_path, temp_webp, args.quality):
-                new_size = temp_webp.stat().st_size
-                
-                # Replace original with WebP version (keeping original filename)
-                shutil.move(temp_webp, img_path)
-                
-                # Update database if requested
-                if conn and not args.skip_database:
-                    if update_database_mime_type(conn, img_path, TARGET_MIME):
-                        logger.info(f"  Database updated for {img_path.name}")
-                    else:
-                        logger.warning(f"  Database update failed for {img_path.name}")
-                
-                converted_count += 1
-                saved = original_size - new_size
-                total_saved += saved
-                
-                logger.info(f"  Converted: {original_size/1024:.1f}KB → {new_size/1024:.1f}KB (saved {saved/1024:.1f}KB)")
-                
-            else:
-                failed_count += 1
-                # Restore from backup if conversion failed
-                shutil.move(backup_path, img_path)
-                logger.error(f"  Conversion failed, restored from backup")
-                
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Error processing {img_path}: {e}")
-    
-    # Close database connection
-    if conn:
-        conn.close()
+    finally:
+        # Files already replaced must get their MIME type even if the run is
+        # interrupted (Ctrl-C, a worker killed for memory, ...)
+        if pool:
+            if pending_updates:
+                flush_updates()
+            pool.close()
     
     # Summary
+    if converted_count == 0 and failed_count == 0 and skipped_count == 0:
+        logger.info("No image files found to optimize")
+        return
+    
     logger.info("Optimization complete!")
     logger.info(f"Converted: {converted_count} files")
     logger.info(f"Failed: {failed_count} files")
+    logger.info(f"Skipped (already WebP): {skipped_count} files")
+    logger.info(f"Processed collection: {total_size / (1024*1024):.2f} MB")
     logger.info(f"Total space saved: {total_saved / (1024*1024):.2f} MB")
     
     if converted_count > 0: